@@ -0,0 +1,111 @@
+import os
+import asyncio
+import httpx
+from groq import AsyncGroq
+
+# Collect concurrent requests for up to 50ms or 16 messages, whichever comes first
+BATCH_WINDOW_SECONDS = 0.05
+BATCH_MAX_SIZE = 16
+
+# One shared client per worker so the HTTP connection pool is reused across events.
+# Pooled connections are bound to the loop that opened them, so the client is rebuilt
+# whenever the running loop changes (same rule as the batcher's queue and worker).
+_GROQ = None
+_GROQ_LOOP = None
+
+
+def groq_client():
+    """Lazily build the shared AsyncGroq client for the running loop (the API key may not be set at import time)"""
+    global _GROQ, _GROQ_LOOP
+    loop = asyncio.get_running_loop()
+    if _GROQ is None or _GROQ_LOOP is not loop:
+        _GROQ = AsyncGroq(
+            api_key=os.getenv("GROQ_API_KEY"),
+            max_retries=2,
+            timeout=30.0,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=64, max_keepalive_connections=32)
+            )
+        )
+        _GROQ_LOOP = loop
+    return _GROQ
+
+class LLMBatcher:
+    """
+    Micro-batches chat completion calls from concurrent handlers.
+
+    Each submit() queues its request and waits on its own future; a background
+    worker closes a batch after BATCH_WINDOW_SECONDS or BATCH_MAX_SIZE items and
+    fires the whole batch concurrently; each caller is resolved as soon as its own call finishes.
+    """
+
+    def __init__(self, max_size=BATCH_MAX_SIZE, window=BATCH_WINDOW_SECONDS):
+        self.max_size = max_size
+        self.window = window
+        self._queue = None
+        self._worker = None
+        # Strong references to in-flight dispatches; unreferenced tasks can be garbage-collected mid-flight
+        self._tasks = set()
+
+    async def submit(self, **params):
+        """Queues a chat.completions.create(**params) call and returns its result"""
+        self._ensure_worker()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((params, future))
+        return await future
+
+    def _ensure_worker(self):
+        # The queue and worker are bound to the running loop, so (re)create them lazily
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+                except asyncio.TimeoutError:
+                    break
+            # Dispatch without waiting so the next window can fill while this batch is in flight
+            task = asyncio.create_task(self._dispatch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _dispatch(self, batch):
+        try:
+            client = groq_client()
+        except Exception as e:
+            # e.g. missing API key - fail every caller instead of leaving them waiting
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        # One task per request, each resolving its caller as soon as it finishes, so a fast call
+        # (e.g. a stream that returns on headers) never waits for a slow one in the same batch
+        tasks = []
+        for params, future in batch:
+            task = asyncio.create_task(client.chat.completions.create(**params))
+            task.add_done_callback(lambda t, future=future: self._resolve(future, t))
+            tasks.append(task)
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    @staticmethod
+    def _resolve(future, task):
+        if future.done():
+            return
+        if task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+
+batcher = LLMBatcher()
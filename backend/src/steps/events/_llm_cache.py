@@ -0,0 +1,34 @@
+import time
+import hashlib
+
+# State group holding cached LLM responses, keyed by a hash of everything that shapes the response
+CACHE_GROUP = "llm_cache"
+CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+
+
+def cache_key(*parts):
+    """Content-addressed key: bump the caller's PROMPT_VERSION to invalidate old entries"""
+    return hashlib.sha256("|".join(str(p) for p in parts).encode("utf-8")).hexdigest()
+
+
+def is_expired(entry):
+    return time.time() - entry.get("cachedAt", 0) > CACHE_TTL_SECONDS
+
+
+async def get_cached(context, key):
+    """Returns the cached raw response for key, or None if missing or expired"""
+    entry = await context.state.get(CACHE_GROUP, key)
+    if not entry:
+        return None
+    if is_expired(entry):
+        await context.state.delete(CACHE_GROUP, key)
+        return None
+    return entry.get("response")
+
+
+async def set_cached(context, key, response):
+    await context.state.set(CACHE_GROUP, key, {
+        "key": key,  # Lets the purge step delete entries found via get_group
+        "response": response,
+        "cachedAt": time.time()
+    })
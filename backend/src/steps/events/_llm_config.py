@@ -0,0 +1,22 @@
+import os
+from typing import Final
+
+# Model shared by classification and extraction (part of both cache keys)
+MODEL: Final[str] = "meta-llama/llama-4-scout-17b-16e-instruct"
+
+# Log banners for LLM request/response logging
+BAR: Final[str] = "=" * 80
+DASH: Final[str] = "-" * 80
+
+
+def env_flag(name):
+    """True when the environment variable is set to 1/true/yes (case-insensitive)"""
+    return os.getenv(name, "").lower() in ("1", "true", "yes")
+
+
+# Body previews and raw AI responses are only formatted and logged (at debug) when enabled
+LOG_LLM_PAYLOADS = env_flag("LOG_LLM_PAYLOADS")
+
+# Email is rarely time-critical: when enabled, email classification is queued for the
+# (cheaper) Groq Batch API and flushed by FlushClassificationBatch instead of called inline.
+BATCH_EMAIL_ENABLED = env_flag("GROQ_BATCH_EMAIL")
@@ -0,0 +1,73 @@
+import re
+from html.parser import HTMLParser
+
+# Input caps for the LLM: classification only needs the opening of a message, extraction needs more detail
+CLASSIFY_MAX_CHARS = 2000
+EXTRACT_MAX_CHARS = 6000
+
+_WHITESPACE_RE = re.compile(r"\s+")
+# "On Mon, 1 Jan 2024 at 10:00, Someone <a@b.com> wrote:" (clients may wrap it onto two lines)
+_QUOTED_REPLY_RE = re.compile(r"^On\b[^\n]*(?:\n[^\n]*)?\bwrote:", re.MULTILINE)
+
+
+class _TextExtractor(HTMLParser):
+    """Collects visible text from HTML, keeping block elements on separate lines"""
+
+    _SKIP_TAGS = {"script", "style", "head", "title"}
+    _BLOCK_TAGS = {"br", "p", "div", "tr", "li", "h1", "h2", "h3", "h4", "h5", "h6", "blockquote"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self._skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self._SKIP_TAGS:
+            self._skip_depth += 1
+        elif tag in self._BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self._SKIP_TAGS and self._skip_depth:
+            self._skip_depth -= 1
+        elif tag in self._BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if not self._skip_depth:
+            self.parts.append(data)
+
+
+def html_to_text(html):
+    """Strips tags, scripts and styles from an HTML body"""
+    parser = _TextExtractor()
+    parser.feed(html)
+    parser.close()
+    return "".join(parser.parts)
+
+
+def prepare_for_llm(text, max_chars, strip_quoted_replies=False):
+    """
+    Shrinks a message body before it is sent to the LLM: optionally drops quoted
+    replies, collapses whitespace, removes repeated lines and caps the length.
+    """
+    if not text:
+        return ""
+
+    if strip_quoted_replies:
+        match = _QUOTED_REPLY_RE.search(text)
+        if match and match.start() > 0:
+            text = text[:match.start()]
+
+    lines = []
+    seen = set()
+    for line in text.splitlines():
+        line = _WHITESPACE_RE.sub(" ", line).strip()
+        if not line or (strip_quoted_replies and line.startswith(">")):
+            continue
+        if line in seen:
+            continue
+        seen.add(line)
+        lines.append(line)
+
+    return "\n".join(lines)[:max_chars]
@@ -0,0 +1,15 @@
+import time
+import datetime
+
+_last_second = None
+_last_iso = ""
+
+
+def now_iso():
+    """Current UTC time as an ISO string; formatted at most once per second and reused within it"""
+    global _last_second, _last_iso
+    second = int(time.time())
+    if second != _last_second:
+        _last_iso = datetime.datetime.fromtimestamp(second, datetime.timezone.utc).isoformat()
+        _last_second = second
+    return _last_iso
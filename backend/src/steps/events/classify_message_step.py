@@ -1,7 +1,11 @@
-import os
-import json
-import datetime
-from groq import Groq
+import re
+import orjson
+from typing import Final
+from _llm_batcher import batcher
+from _llm_config import BAR, BATCH_EMAIL_ENABLED, DASH, LOG_LLM_PAYLOADS, MODEL
+from _llm_cache import cache_key, get_cached, set_cached
+from _text_prep import CLASSIFY_MAX_CHARS, EXTRACT_MAX_CHARS, html_to_text, prepare_for_llm
+from _timestamps import now_iso
 
 config = {
     "type": "event",
@@ -13,6 +17,7 @@ config = {
             "messageId": {"type": "string"},
             "source": {"type": "string"},
             "body": {"type": "string"},
+            "html": {"type": ["string", "null"]},  # Fallback when only an HTML body is available
             "senderId": {"type": "string"},
             "sender": {
                 "type": "object",
@@ -28,44 +33,38 @@ config = {
         "required": ["messageId", "source", "body"]
     },
     "emits": ["message.classified"],
-    "description": "Classifies if a message is a brand collaboration inquiry using AI",
+    "description": "Classifies if a message is a brand collaboration inquiry using AI (and extracts deal details for brand inquiries)",
     "flows": ["inquiry-processing"]
 }
 
-async def handler(input_data, context):
-    """
-    Classifies if a message is related to brand collaboration/influencer marketing.
-    
-    Input: { messageId, source, body, senderId?, sender?, subject? }
-    Output: Emits message.classified with { isBrandInquiry, confidence, reasoning }
-    """
-    message_id = input_data.get("messageId")
-    body = input_data.get("body") or input_data.get("html", "")
-    source = input_data.get("source")
-    subject = input_data.get("subject") or ""
-    
-    # Use enriched sender info if available
-    sender = input_data.get("sender", {})
-    sender_name = sender.get("name")
-    
-    context.logger.info("=" * 80)
-    context.logger.info(f"CLASSIFYING MESSAGE: {message_id}")
-    context.logger.info("=" * 80)
-    context.logger.info(f"Source: {source}")
-    context.logger.info(f"Sender: {sender_name or input_data.get('senderId')}")
-    context.logger.info(f"Subject: {subject}")
-    context.logger.info(f"Body Preview: {body[:100] if body else 'NO BODY'}...")
-    
-    if not body:
-        context.logger.warn(f"No message body for {message_id}")
-        return
-    
-    try:
-        # Initialize Groq client
-        client = Groq(api_key=os.getenv("GROQ_API_KEY"))
-        
-        # System prompt for classification
-        system_prompt = """You are a message classifier for a Creator Operating System in India.
+# Bump when the system prompt changes so cached classifications are invalidated
+PROMPT_VERSION: Final[str] = "2"
+# Classification alone is <100 tokens, but brand inquiries also carry the fused extraction (<400)
+MAX_TOKENS: Final[int] = 700
+
+# Email classifications queued for FlushClassificationBatch when BATCH_EMAIL_ENABLED is set
+BATCH_PENDING_GROUP = "groq_batch_pending"
+
+# Most messages are not brand inquiries and the verdict comes first in the JSON, so the
+# stream is cut as soon as a confident "not a brand inquiry" is visible.
+EARLY_EXIT_CONFIDENCE = 0.9
+_EARLY_VERDICT_RE = re.compile(r'"isBrandInquiry"\s*:\s*(true|false)\s*,\s*"confidence"\s*:\s*([0-9.]+)\s*[,}]')
+
+# Cheap gate in front of the LLM: only messages that are clearly trivial (emoji/punctuation only,
+# a few characters, or nothing but greetings/pleasantries) skip the model. Anything else, however
+# short, is classified by the model - a missed inquiry can't be recovered downstream.
+_TRIVIAL_MAX_CHARS = 3
+_WORD_RE = re.compile(r"\w")
+_GREETING_ONLY_RE = re.compile(
+    r"^(?:(?:hi+|hello+|hey+|hiya|yo|sup|hola|namaste|gm|gn|good\s+(?:morning|afternoon|evening|night)|"
+    r"thanks?|thank\s+you|thx|ty|ok(?:ay)?|cool|nice|great|wow|lol|haha+|love\s+(?:it|this|you|your\s+content)|"
+    r"follow\s+back|f4f|pl[sz]|please|there|bro|sis|dear|sir|ma'?am|all|guys)[\W_]*)+$",
+    re.IGNORECASE
+)
+_prefiltered_count = 0
+
+# Static classification prompt, sent first so Groq can reuse the cached prefix
+SYSTEM_PROMPT: Final[str] = """You are a message classifier for a Creator Operating System in India.
 
 Your task: Determine if a message is a BRAND COLLABORATION INQUIRY.
 
@@ -89,149 +88,298 @@ Return ONLY valid JSON:
   "isBrandInquiry": true or false,
   "confidence": 0.0 to 1.0,
   "reasoning": "Brief explanation of your decision",
-  "keywords": ["list", "of", "relevant", "keywords", "found"]
+  "keywords": ["list", "of", "relevant", "keywords", "found"],
+  "extracted": null
 }
 
+If isBrandInquiry is true, also extract the collaboration details and set "extracted" to:
+{
+  "brand": {
+    "contactPerson": "Person's name or null",
+    "email": "Email address or null"
+  },
+  "campaign": {
+    "deliverables": [
+      {
+        "type": "instagram_reel|instagram_post|youtube_video|youtube_short|other",
+        "count": 1,
+        "description": "What they want"
+      }
+    ],
+    "timeline": "Timeline string like '2 weeks' or null",
+    "budget": {
+      "mentioned": true or false,
+      "amount": number or null,
+      "currency": "INR"
+    }
+  },
+  "urgency": "high|medium|low",
+  "additionalNotes": "Other relevant info or empty string"
+}
+If isBrandInquiry is false, leave "extracted" as null.
+
 CRITICAL: Return ONLY the JSON object. No markdown, no explanations."""
+SYSTEM_MESSAGE: Final[dict] = {"role": "system", "content": SYSTEM_PROMPT}
+
+
+def build_request(full_text, stream=False):
+    """Chat completion parameters for classifying full_text (shared with the batch flush step)"""
+    params = {
+        "model": MODEL,
+        "messages": [
+            SYSTEM_MESSAGE,
+            {"role": "user", "content": full_text}
+        ],
+        "temperature": 0.2,  # Lower temperature for more consistent classification
+        "max_tokens": MAX_TOKENS
+    }
+    if stream:
+        # JSON mode can't be streamed; the prompt already demands a bare JSON object
+        params["stream"] = True
+    else:
+        params["response_format"] = {"type": "json_object"}
+    return params
+
+
+def _is_trivial(text):
+    """True for text that can't be a brand inquiry: no words, a few characters, or only greetings"""
+    text = text.strip()
+    return not _WORD_RE.search(text) or len(text) <= _TRIVIAL_MAX_CHARS or bool(_GREETING_ONLY_RE.match(text))
+
+
+def _carry_email_headers(dst, src):
+    """Passes email threading metadata through to the emitted event"""
+    if src.get("source") == "email":
+        for field in ("inReplyTo", "references", "emailHeaders"):
+            value = src.get(field)
+            if value:
+                dst[field] = value
+
+
+def _build_emit(input_data, is_brand_inquiry, confidence, reasoning, keywords):
+    """Builds the message.classified payload for a message and its classification"""
+    emit_data = {
+        "messageId": input_data.get("messageId"),
+        "source": input_data.get("source"),
+        "body": input_data.get("body") or input_data.get("html") or "",
+        "subject": input_data.get("subject") or "",
+        "senderId": input_data.get("senderId"),
+        "sender": input_data.get("sender", {}), # Pass enriched sender info
+        "pageName": input_data.get("pageName"),
+        "isBrandInquiry": is_brand_inquiry,
+        "confidence": confidence,
+        "reasoning": reasoning,
+        "keywords": keywords,
+        "classifiedAt": now_iso()
+    }
+    _carry_email_headers(emit_data, input_data)
+    return emit_data
+
+
+async def stream_classification(full_text):
+    """
+    Streams the classification and returns the raw JSON. Stops early with a minimal
+    result once the model has committed to a confident non-brand verdict; falls back to
+    a non-streamed JSON mode call when the streamed output isn't a JSON object.
+    """
+    stream = await batcher.submit(**build_request(full_text, stream=True))
+    content = ""
+    verdict_seen = False
+    async for chunk in stream:
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if not delta:
+            continue
+        content += delta
+        if verdict_seen:
+            continue
+        
+        match = _EARLY_VERDICT_RE.search(content)
+        if not match:
+            continue
+        verdict_seen = True
+        confidence = float(match.group(2))
+        if match.group(1) == "false" and confidence > EARLY_EXIT_CONFIDENCE:
+            await stream.close()
+            return orjson.dumps({
+                "isBrandInquiry": False,
+                "confidence": confidence,
+                "reasoning": "Confident non-brand verdict (stream stopped early)",
+                "keywords": []
+            }).decode("utf-8")
+    
+    # Without JSON mode the model may wrap the object in a fence or preamble
+    recovered = _recover_json_object(content)
+    if recovered is not None:
+        return recovered
+    
+    # Don't let a chatty response turn a real inquiry into "not a brand inquiry": retry once in JSON mode
+    completion = await batcher.submit(**build_request(full_text))
+    return completion.choices[0].message.content
+
+
+def _recover_json_object(content):
+    """Returns content (or its outermost {...}) if it parses as a JSON object, else None"""
+    start, end = content.find("{"), content.rfind("}")
+    for candidate in (content.strip(), content[start:end + 1] if 0 <= start < end else None):
+        if not candidate:
+            continue
+        try:
+            if isinstance(orjson.loads(candidate), dict):
+                return candidate
+        except orjson.JSONDecodeError:
+            continue
+    return None
+
+
+async def handler(input_data, context):
+    """
+    Classifies if a message is related to brand collaboration/influencer marketing.
+    
+    Input: { messageId, source, body, senderId?, sender?, subject? }
+    Output: Emits message.classified with { isBrandInquiry, confidence, reasoning, preExtracted? }
+    """
+    global _prefiltered_count
+    message_id = input_data.get("messageId")
+    body = input_data.get("body") or input_data.get("html") or ""
+    source = input_data.get("source")
+    subject = input_data.get("subject") or ""
+    
+    # Use enriched sender info if available
+    sender = input_data.get("sender", {})
+    sender_name = sender.get("name")
+    
+    context.logger.info(BAR)
+    context.logger.info(f"CLASSIFYING MESSAGE: {message_id}")
+    context.logger.info(BAR)
+    context.logger.info(f"Source: {source}")
+    context.logger.info(f"Sender: {sender_name or input_data.get('senderId')}")
+    context.logger.info(f"Subject: {subject}")
+    if LOG_LLM_PAYLOADS and body:
+        context.logger.debug(f"Body Preview: {body[:100]}...")
+    
+    if not body:
+        context.logger.warn(f"No message body for {message_id}")
+        return
+    
+    try:
+        # Classification only needs the opening of the message, as plain text
+        # (email bodies and html-only payloads can be full HTML documents)
+        may_be_html = source == "email" or not input_data.get("body")
+        text_body = html_to_text(body) if may_be_html and "<" in body else body
+        llm_body = prepare_for_llm(text_body, CLASSIFY_MAX_CHARS)
+        # The fused extraction only saw the classification input; trust it only when that is everything
+        # ExtractInquiry would see (not truncated, no quoted replies), otherwise let ExtractInquiry run
+        use_fused_extraction = llm_body == prepare_for_llm(text_body, EXTRACT_MAX_CHARS, strip_quoted_replies=True)
+        
+        # Replies in an existing email thread always go to the model
+        if not input_data.get("inReplyTo") and _is_trivial(f"{subject} {llm_body}"):
+            _prefiltered_count += 1
+            context.logger.info(f"⏭️  Prefilter: trivial message {message_id}, skipping AI classification (prefiltered so far: {_prefiltered_count})")
+            await context.emit({
+                "topic": "message.classified",
+                "data": _build_emit(input_data, False, 0.95, "prefilter: trivial message (greeting/emoji/too short)", [])
+            })
+            return
         
         # Combine subject and body for email context
-        full_text = f"Subject: {subject}\n\n{body}" if subject else body
+        full_text = f"Subject: {subject}\n\n{llm_body}" if subject else llm_body
         
         # Add sender context if available
         if sender_name:
              full_text = f"Sender Name: {sender_name}\n{full_text}"
 
-        # Call Groq API
-        completion = client.chat.completions.create(
-            model="meta-llama/llama-4-scout-17b-16e-instruct",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": full_text}
-            ],
-            response_format={"type": "json_object"},
-            temperature=0.2  # Lower temperature for more consistent classification
-        )
-        
-        # Parse JSON response
-        classification_json = completion.choices[0].message.content
+        # Reuse the classification for duplicate/replayed messages
+        key = cache_key(MODEL, PROMPT_VERSION, full_text)
+        classification_json = await get_cached(context, key)
+        from_cache = classification_json is not None
         
-        context.logger.info(f"AI Classification Response: {classification_json}")
-        context.logger.info("-" * 80)
-        
-        try:
-            classification = json.loads(classification_json)
-            
-            is_brand_inquiry = classification.get("isBrandInquiry", False)
-            confidence = classification.get("confidence", 0.0)
-            reasoning = classification.get("reasoning", "No reasoning provided")
-            keywords = classification.get("keywords", [])
-            
-            # Log classification result
-            context.logger.info(f"Classification Result: {'✅ BRAND INQUIRY' if is_brand_inquiry else '❌ NOT BRAND INQUIRY'}")
-            context.logger.info(f"Confidence: {confidence:.2%}")
-            context.logger.info(f"Reasoning: {reasoning}")
-            context.logger.info(f"Keywords Found: {', '.join(keywords) if keywords else 'None'}")
-            context.logger.info("=" * 80)
-            
-            # Emit classification result
-            emit_data = {
-                "messageId": message_id,
-                "source": source,
-                "body": body,
-                "subject": subject,
-                "senderId": input_data.get("senderId"),
-                "sender": sender, # Pass enriched sender info
-                "pageName": input_data.get("pageName"),
-                "isBrandInquiry": is_brand_inquiry,
-                "confidence": confidence,
-                "reasoning": reasoning,
-                "keywords": keywords,
-                "classifiedAt": datetime.datetime.now().isoformat()
-            }
-            # Pass through email threading metadata if available
-            if source == "email":
-                if input_data.get("inReplyTo"):
-                    emit_data["inReplyTo"] = input_data.get("inReplyTo")
-                if input_data.get("references"):
-                    emit_data["references"] = input_data.get("references")
-                if input_data.get("emailHeaders"):
-                    emit_data["emailHeaders"] = input_data.get("emailHeaders")
-            
-            await context.emit({
-                "topic": "message.classified",
-                "data": emit_data
-            })
-            
-            context.logger.info(f"✅ Classification event emitted for {message_id}")
-            
-        except json.JSONDecodeError as json_err:
-            context.logger.error("=" * 80)
-            context.logger.error(f"❌ JSON PARSE ERROR for Classification: {message_id}")
-            context.logger.error(f"Raw Response: {classification_json}")
-            context.logger.error(f"Error: {str(json_err)}")
-            context.logger.error("=" * 80)
-            # Default to NOT brand inquiry if parsing fails
-            emit_data = {
+        if from_cache:
+            context.logger.info(f"Using cached classification for {message_id}")
+        elif source == "email" and BATCH_EMAIL_ENABLED:
+            await context.state.set(BATCH_PENDING_GROUP, message_id, {
                 "messageId": message_id,
-                "source": source,
-                "body": body,
-                "subject": subject,
-                "senderId": input_data.get("senderId"),
-                "sender": sender,
-                "pageName": input_data.get("pageName"),
-                "isBrandInquiry": False,
-                "confidence": 0.0,
-                "reasoning": f"Classification failed: {str(json_err)}",
-                "keywords": [],
-                "classifiedAt": datetime.datetime.now().isoformat()
-            }
-            # Pass through email threading metadata if available
-            if source == "email":
-                if input_data.get("inReplyTo"):
-                    emit_data["inReplyTo"] = input_data.get("inReplyTo")
-                if input_data.get("references"):
-                    emit_data["references"] = input_data.get("references")
-                if input_data.get("emailHeaders"):
-                    emit_data["emailHeaders"] = input_data.get("emailHeaders")
-            
-            await context.emit({
-                "topic": "message.classified",
-                "data": emit_data
+                "input": input_data,
+                "fullText": full_text,
+                "cacheKey": key,
+                "useFusedExtraction": use_fused_extraction,
+                "queuedAt": now_iso()
             })
-            
+            context.logger.info(f"📦 Queued {message_id} for batch classification")
+            return
+        else:
+            # Call Groq API
+            classification_json = await stream_classification(full_text)
+        
+        await emit_classification(context, input_data, classification_json, None if from_cache else key, use_fused_extraction)
+        
     except Exception as e:
-        context.logger.error("=" * 80)
+        context.logger.error(BAR)
         context.logger.error(f"❌ CLASSIFICATION FAILED for Message: {message_id}")
         context.logger.error(f"Error Type: {type(e).__name__}")
         context.logger.error(f"Error Message: {str(e)}")
-        context.logger.error("=" * 80)
+        context.logger.error(BAR)
         
         # Emit with default (not brand inquiry) on error
-        emit_data = {
-            "messageId": message_id,
-            "source": source,
-            "body": body,
-            "subject": subject,
-            "senderId": input_data.get("senderId"),
-            "sender": sender,
-            "pageName": input_data.get("pageName"),
-            "isBrandInquiry": False,
-            "confidence": 0.0,
-            "reasoning": f"Classification error: {str(e)}",
-            "keywords": [],
-            "classifiedAt": datetime.datetime.now().isoformat()
-        }
-        # Pass through email threading metadata if available
-        if source == "email":
-            if input_data.get("inReplyTo"):
-                emit_data["inReplyTo"] = input_data.get("inReplyTo")
-            if input_data.get("references"):
-                emit_data["references"] = input_data.get("references")
-            if input_data.get("emailHeaders"):
-                emit_data["emailHeaders"] = input_data.get("emailHeaders")
+        emit_data = _build_emit(input_data, False, 0.0, f"Classification error: {str(e)}", [])
         
         await context.emit({
             "topic": "message.classified",
             "data": emit_data
         })
 
+
+async def emit_classification(context, input_data, classification_json, key=None, use_fused_extraction=True):
+    """
+    Parses a raw classification response and emits message.classified; caches it under key when given.
+    The fused extraction is forwarded as preExtracted only when use_fused_extraction is set.
+    """
+    message_id = input_data.get("messageId")
+    
+    if LOG_LLM_PAYLOADS:
+        context.logger.debug(f"AI Classification Response: {classification_json}")
+    context.logger.info(DASH)
+    
+    try:
+        classification = orjson.loads(classification_json)
+        if key:
+            await set_cached(context, key, classification_json)
+        
+        is_brand_inquiry = classification.get("isBrandInquiry", False)
+        confidence = classification.get("confidence", 0.0)
+        reasoning = classification.get("reasoning", "No reasoning provided")
+        keywords = classification.get("keywords", [])
+        # Extraction fused into the same call; ExtractInquiry skips its own AI call when present
+        pre_extracted = classification.get("extracted") if is_brand_inquiry and use_fused_extraction else None
+        
+        # Log classification result
+        context.logger.info(f"Classification Result: {'✅ BRAND INQUIRY' if is_brand_inquiry else '❌ NOT BRAND INQUIRY'}")
+        context.logger.info(f"Confidence: {confidence:.2%}")
+        context.logger.info(f"Reasoning: {reasoning}")
+        context.logger.info(f"Keywords Found: {', '.join(keywords) if keywords else 'None'}")
+        context.logger.info(BAR)
+        
+        # Emit classification result
+        emit_data = _build_emit(input_data, is_brand_inquiry, confidence, reasoning, keywords)
+        if isinstance(pre_extracted, dict):
+            emit_data["preExtracted"] = pre_extracted
+        
+        await context.emit({
+            "topic": "message.classified",
+            "data": emit_data
+        })
+        
+        context.logger.info(f"✅ Classification event emitted for {message_id}")
+        
+    except orjson.JSONDecodeError as json_err:
+        context.logger.error(BAR)
+        context.logger.error(f"❌ JSON PARSE ERROR for Classification: {message_id}")
+        context.logger.error(f"Raw Response: {classification_json}")
+        context.logger.error(f"Error: {str(json_err)}")
+        context.logger.error(BAR)
+        # Default to NOT brand inquiry if parsing fails
+        emit_data = _build_emit(input_data, False, 0.0, f"Classification failed: {str(json_err)}", [])
+        
+        await context.emit({
+            "topic": "message.classified",
+            "data": emit_data
+        })
@@ -1,7 +1,11 @@
-import os
-import json
-import datetime
-from groq import Groq
+import asyncio
+import orjson
+from typing import Final
+from _llm_batcher import batcher
+from _llm_config import BAR, DASH, LOG_LLM_PAYLOADS, MODEL
+from _llm_cache import cache_key, get_cached, set_cached
+from _text_prep import EXTRACT_MAX_CHARS, prepare_for_llm
+from _timestamps import now_iso
 
 config = {
     "type": "event",
@@ -22,7 +26,8 @@ config = {
                     "platform": {"type": "string"},
                     "id": {"type": "string"}
                 }
-            }
+            },
+            "preExtracted": {"type": ["object", "null"]}
         },
         "required": ["inquiryId", "source", "body"]
     },
@@ -31,36 +36,13 @@ config = {
     "flows": ["inquiry-processing", "dealflow"]
 }
 
-async def handler(input_data, context):
-    """
-    Extracts brand collaboration details from raw inquiry text using Groq's Llama 4 Scout.
-    
-    Input: { inquiryId, source, body, senderId?, sender? }
-    Output: Emits inquiry.extracted with structured data
-    """
-    inquiry_id = input_data.get("inquiryId")
-    body = input_data.get("body")
-    source = input_data.get("source")
-    thread_key = input_data.get("threadKey")
-    # Capture sender from input to pass it forward
-    sender = input_data.get("sender")
-    
-    context.logger.info(f"Starting extraction for {inquiry_id}")
-    if sender:
-        context.logger.info(f"Sender in input: {sender.get('name')}")
-    
-    context.logger.info(f"AI Extraction Input: {body}")
+# Bump when the system prompt changes so cached extractions are invalidated
+PROMPT_VERSION: Final[str] = "1"
+# The extraction JSON is <400 tokens; cap decoding so a runaway response can't stall the step
+MAX_TOKENS: Final[int] = 600
 
-    if not body:
-        context.logger.warn(f"No message body for inquiry {inquiry_id}")
-        return
-    
-    try:
-        # Initialize Groq client
-        client = Groq(api_key=os.getenv("GROQ_API_KEY"))
-        
-        # System prompt for extraction
-        system_prompt = """You are a data extraction AI for a Creator Operating System in India.
+# Static extraction prompt; only the user message changes between requests
+SYSTEM_PROMPT: Final[str] = """You are a data extraction AI for a Creator Operating System in India.
 
 Extract brand collaboration details from the message and return ONLY valid JSON.
 
@@ -90,77 +72,81 @@ Required JSON structure:
 }
 
 CRITICAL: Return ONLY the JSON object. No markdown code blocks, no explanations."""
-        
-        # Call Groq API
-        # Using meta-llama/llama-4-scout-17b-16e-instruct as primary model
-        completion = client.chat.completions.create(
-            model="meta-llama/llama-4-scout-17b-16e-instruct",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": body}
-            ],
-            response_format={"type": "json_object"},
-            temperature=0.3
-        )
-        
-        # Parse JSON response
-        extracted_json = completion.choices[0].message.content
-        
-        # Enhanced logging for AI response
-        context.logger.info("=" * 80)
-        context.logger.info(f"AI EXTRACTION RESPONSE for Inquiry: {inquiry_id}")
-        context.logger.info("=" * 80)
-        context.logger.info(f"Raw AI Response: {extracted_json}")
-        context.logger.info("-" * 80)
-        
-        try:
-            extracted = json.loads(extracted_json)
-            
-            # Log structured data
-            context.logger.info(f"Parsed Contact Person: {extracted.get('brand', {}).get('contactPerson', 'N/A')}")
-            context.logger.info(f"Parsed Email: {extracted.get('brand', {}).get('email', 'N/A')}")
-            context.logger.info(f"Deliverables Count: {len(extracted.get('campaign', {}).get('deliverables', []))}")
-            context.logger.info(f"Timeline: {extracted.get('campaign', {}).get('timeline', 'N/A')}")
-            context.logger.info(f"Budget Mentioned: {extracted.get('campaign', {}).get('budget', {}).get('mentioned', False)}")
-            if extracted.get('campaign', {}).get('budget', {}).get('mentioned'):
-                context.logger.info(f"Budget Amount: ₹{extracted.get('campaign', {}).get('budget', {}).get('amount', 'N/A')}")
-            context.logger.info(f"Urgency: {extracted.get('urgency', 'N/A')}")
-            context.logger.info("=" * 80)
-            context.logger.info(f"✅ Successfully extracted and parsed data for {inquiry_id}")
-            
-        except json.JSONDecodeError as json_err:
-            context.logger.error("=" * 80)
-            context.logger.error(f"❌ JSON PARSE ERROR for Inquiry: {inquiry_id}")
-            context.logger.error(f"Raw Response: {extracted_json}")
-            context.logger.error(f"Error: {str(json_err)}")
-            context.logger.error("=" * 80)
-            await mark_as_failed(context, inquiry_id, f"JSON parse error: {str(json_err)}")
-            return
+SYSTEM_MESSAGE: Final[dict] = {"role": "system", "content": SYSTEM_PROMPT}
+
+
+async def handler(input_data, context):
+    """
+    Extracts brand collaboration details from raw inquiry text using Groq's Llama 4 Scout.
+    
+    Input: { inquiryId, source, body, senderId?, sender?, preExtracted? }
+    Output: Emits inquiry.extracted with structured data
+    """
+    inquiry_id = input_data.get("inquiryId")
+    body = input_data.get("body")
+    source = input_data.get("source")
+    thread_key = input_data.get("threadKey")
+    # Capture sender from input to pass it forward
+    sender = input_data.get("sender")
+    # Set when ClassifyMessage already extracted the deal details in its fused call
+    pre_extracted = input_data.get("preExtracted")
+    
+    context.logger.info(f"Starting extraction for {inquiry_id}")
+    if sender:
+        context.logger.info(f"Sender in input: {sender.get('name')}")
+    
+    if LOG_LLM_PAYLOADS:
+        context.logger.debug(f"AI Extraction Input: {body}")
+
+    if not body:
+        context.logger.warn(f"No message body for inquiry {inquiry_id}")
+        return
+    
+    try:
+        if isinstance(pre_extracted, dict):
+            # Classification already extracted the details in the same call
+            context.logger.info(f"Using pre-extracted data from classification for {inquiry_id}, skipping AI extraction")
+            extracted = pre_extracted
+            inquiry = await context.state.get("inquiries", inquiry_id)
+        else:
+            # The state fetch doesn't depend on the LLM result, so overlap it with the call
+            extracted, inquiry = await asyncio.gather(
+                extract_with_ai(context, inquiry_id, body),
+                context.state.get("inquiries", inquiry_id)
+            )
+            if extracted is None:
+                return
         
         # Update inquiry in state
-        inquiry = await context.state.get("inquiries", inquiry_id)
         if not inquiry:
             context.logger.error(f"Inquiry {inquiry_id} not found in state")
             inquiry = {"id": inquiry_id}
         
         original_body = inquiry.get("body", body)
+        stored = dict(inquiry)
         
         inquiry["status"] = "extracted"
         inquiry["extractedData"] = extracted
-        inquiry["extractedAt"] = datetime.datetime.now().isoformat()
         inquiry["body"] = original_body  # Explicitly preserve body
         
         # Ensure sender is preserved or added if missing in state
         if sender and not inquiry.get("sender"):
              inquiry["sender"] = sender
 
-        await context.state.set("inquiries", inquiry_id, inquiry)
-        
-        context.logger.info(f"Inquiry updated with body preserved: hasBody={bool(inquiry.get('body'))}, bodyLength={len(inquiry.get('body', ''))}")
-        
-        context.logger.info(f"✅ Inquiry updated in state: {inquiry_id}")
+        # Replayed events re-extract the same data; only write (and restamp extractedAt) when a written field changed
+        if any(inquiry.get(field) != stored.get(field) for field in ("status", "extractedData", "body", "sender")):
+            inquiry["extractedAt"] = now_iso()
+            await context.state.set("inquiries", inquiry_id, inquiry)
+            
+            context.logger.info(f"Inquiry updated with body preserved: hasBody={bool(inquiry.get('body'))}, bodyLength={len(inquiry.get('body', ''))}")
+            
+            context.logger.info(f"✅ Inquiry updated in state: {inquiry_id}")
+        else:
+            context.logger.info(f"Inquiry {inquiry_id} already up to date, skipping state write")
         
-        # Emit extracted event for next step (deal creation)
+        # Emit extracted event for next step (deal creation). Deliberately not gathered with the
+        # state write above: CreateDealFromInquiry reads this inquiry and writes it back with
+        # dealId/status, so a write landing after the emit could clobber the deal link.
         await context.emit({
             "topic": "inquiry.extracted",
             "data": {
@@ -175,15 +161,84 @@ CRITICAL: Return ONLY the JSON object. No markdown code blocks, no explanations.
         context.logger.info(f"✅ Emitted inquiry.extracted event for {inquiry_id}")
         
     except Exception as e:
-        context.logger.error("=" * 80)
+        context.logger.error(BAR)
         context.logger.error(f"❌ EXTRACTION FAILED for Inquiry: {inquiry_id}")
         context.logger.error(f"Error Type: {type(e).__name__}")
         context.logger.error(f"Error Message: {str(e)}")
         context.logger.error(f"Stack Trace: {str(e.__traceback__) if hasattr(e, '__traceback__') else 'N/A'}")
-        context.logger.error("=" * 80)
+        context.logger.error(BAR)
         await mark_as_failed(context, inquiry_id, str(e))
 
 
+async def extract_with_ai(context, inquiry_id, body):
+    """Runs the Groq extraction for a message body; returns None (and marks the inquiry failed) on unparseable output"""
+    # Drop quoted replies and boilerplate; extraction keeps a larger cap than classification
+    llm_body = prepare_for_llm(body, EXTRACT_MAX_CHARS, strip_quoted_replies=True)
+    
+    # Reuse the extraction for duplicate/replayed messages
+    key = cache_key(MODEL, PROMPT_VERSION, llm_body)
+    extracted_json = await get_cached(context, key)
+    from_cache = extracted_json is not None
+    
+    if from_cache:
+        context.logger.info(f"Using cached extraction for {inquiry_id}")
+    else:
+        # Call Groq API
+        # Using meta-llama/llama-4-scout-17b-16e-instruct as primary model
+        completion = await batcher.submit(
+            model=MODEL,
+            messages=[
+                SYSTEM_MESSAGE,
+                {"role": "user", "content": llm_body}
+            ],
+            response_format={"type": "json_object"},
+            temperature=0.3,
+            max_tokens=MAX_TOKENS
+        )
+        
+        # Parse JSON response
+        extracted_json = completion.choices[0].message.content
+    
+    # Enhanced logging for AI response
+    context.logger.info(BAR)
+    context.logger.info(f"AI EXTRACTION RESPONSE for Inquiry: {inquiry_id}")
+    context.logger.info(BAR)
+    if LOG_LLM_PAYLOADS:
+        context.logger.debug(f"Raw AI Response: {extracted_json}")
+    context.logger.info(DASH)
+    
+    try:
+        extracted = orjson.loads(extracted_json)
+        if not from_cache:
+            await set_cached(context, key, extracted_json)
+        
+        # Log structured data
+        brand = extracted.get("brand") or {}
+        campaign = extracted.get("campaign") or {}
+        budget = campaign.get("budget") or {}
+        context.logger.info(f"Parsed Contact Person: {brand.get('contactPerson', 'N/A')}")
+        context.logger.info(f"Parsed Email: {brand.get('email', 'N/A')}")
+        context.logger.info(f"Deliverables Count: {len(campaign.get('deliverables') or [])}")
+        context.logger.info(f"Timeline: {campaign.get('timeline', 'N/A')}")
+        context.logger.info(f"Budget Mentioned: {budget.get('mentioned', False)}")
+        if budget.get('mentioned'):
+            context.logger.info(f"Budget Amount: ₹{budget.get('amount', 'N/A')}")
+        context.logger.info(f"Urgency: {extracted.get('urgency', 'N/A')}")
+        context.logger.info(BAR)
+        context.logger.info(f"✅ Successfully extracted and parsed data for {inquiry_id}")
+        
+    except orjson.JSONDecodeError as json_err:
+        context.logger.error(BAR)
+        context.logger.error(f"❌ JSON PARSE ERROR for Inquiry: {inquiry_id}")
+        context.logger.error(f"Raw Response: {extracted_json}")
+        context.logger.error(f"Error: {str(json_err)}")
+        context.logger.error(BAR)
+        await mark_as_failed(context, inquiry_id, f"JSON parse error: {str(json_err)}")
+        return None
+    
+    return extracted
+
+
 async def mark_as_failed(context, inquiry_id, error_msg):
     """Helper to mark inquiry as extraction_failed"""
     inquiry = await context.state.get("inquiries", inquiry_id) or {"id": inquiry_id}
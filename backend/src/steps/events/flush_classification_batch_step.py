@@ -0,0 +1,146 @@
+import orjson
+from datetime import datetime, timedelta, timezone
+from _llm_batcher import groq_client
+from classify_message_step import BATCH_PENDING_GROUP, build_request, emit_classification, stream_classification
+
+config = {
+    "type": "cron",
+    "name": "FlushClassificationBatch",
+    "description": "Submits queued email classifications to the Groq Batch API and emits results of finished batches",
+    "cron": "*/5 * * * *",
+    "emits": ["message.classified"],
+    "flows": ["inquiry-processing"]
+}
+
+BATCH_JOBS_GROUP = "groq_batch_jobs"
+# Batches still running after this are cancelled and classified on the sync path instead
+BATCH_FALLBACK_MINUTES = 30
+FAILED_STATUSES = ("failed", "expired", "cancelled")
+
+
+async def handler(context):
+    """
+    Collects finished Groq batches, then submits everything queued since the last run.
+
+    Pending entries (groq_batch_pending) are written by ClassifyMessage for email messages.
+    """
+    jobs = await context.state.get_group(BATCH_JOBS_GROUP) or []
+    for job in jobs:
+        try:
+            await collect_job(context, job)
+        except Exception as e:
+            context.logger.error(f"❌ Failed to collect classification batch {job.get('id')}: {str(e)}")
+
+    pending = await context.state.get_group(BATCH_PENDING_GROUP) or []
+    if not pending:
+        return
+
+    try:
+        await submit_batch(context, pending)
+    except Exception as e:
+        # Entries stay pending and are retried on the next run
+        context.logger.error(f"❌ Failed to submit classification batch ({len(pending)} messages): {str(e)}")
+
+
+async def submit_batch(context, pending):
+    """Uploads the pending requests as JSONL and creates a Groq batch for them"""
+    lines = [
+        orjson.dumps({
+            "custom_id": entry["messageId"],
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": build_request(entry["fullText"])
+        })
+        for entry in pending
+    ]
+
+    client = groq_client()
+    batch_file = await client.files.create(
+        file=("classification_batch.jsonl", b"\n".join(lines)),
+        purpose="batch"
+    )
+    batch = await client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+
+    await context.state.set(BATCH_JOBS_GROUP, batch.id, {
+        "id": batch.id,
+        "entries": pending,
+        "submittedAt": datetime.now(timezone.utc).isoformat()
+    })
+    for entry in pending:
+        await context.state.delete(BATCH_PENDING_GROUP, entry["messageId"])
+
+    context.logger.info(f"📦 Submitted classification batch {batch.id} with {len(pending)} messages")
+
+
+async def collect_job(context, job):
+    """Emits results for a completed batch, or falls back to sync classification when it failed or ran too long"""
+    client = groq_client()
+    batch = await client.batches.retrieve(job["id"])
+    job.setdefault("entries", [])
+    entries = job["entries"]
+
+    if batch.status == "completed":
+        responses = {}
+        if batch.output_file_id:
+            output = await client.files.content(batch.output_file_id)
+            for line in (await output.text()).splitlines():
+                if not line.strip():
+                    continue
+                row = orjson.loads(line)
+                response = row.get("response") or {}
+                if response.get("status_code") == 200:
+                    responses[row["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+
+        context.logger.info(f"✅ Classification batch {job['id']} completed: {len(responses)}/{len(entries)} succeeded")
+        for entry in list(entries):
+            emitted = False
+            if entry["messageId"] in responses:
+                try:
+                    await emit_classification(context, entry["input"], responses[entry["messageId"]], entry.get("cacheKey"), entry.get("useFusedExtraction", True))
+                    emitted = True
+                except Exception as e:
+                    context.logger.error(f"❌ Failed to emit batch result for {entry['messageId']}, falling back to sync: {str(e)}")
+            if not emitted:
+                # Row failed inside the batch, or its result couldn't be emitted
+                await classify_sync(context, entry)
+            await finish_entry(context, job, entry)
+
+        await context.state.delete(BATCH_JOBS_GROUP, job["id"])
+        return
+
+    submitted_at = datetime.fromisoformat(job["submittedAt"])
+    timed_out = datetime.now(timezone.utc) - submitted_at > timedelta(minutes=BATCH_FALLBACK_MINUTES)
+
+    if batch.status not in FAILED_STATUSES and not timed_out:
+        context.logger.info(f"Classification batch {job['id']} still {batch.status}")
+        return
+
+    context.logger.warn(f"⚠️ Classification batch {job['id']} {batch.status if not timed_out else 'timed out'}, falling back to sync classification")
+    if batch.status not in FAILED_STATUSES:
+        await client.batches.cancel(job["id"])
+
+    for entry in list(entries):
+        await classify_sync(context, entry)
+        await finish_entry(context, job, entry)
+
+    await context.state.delete(BATCH_JOBS_GROUP, job["id"])
+
+
+async def finish_entry(context, job, entry):
+    """Drops a handled entry from the stored job so a retried collection never emits it twice"""
+    job["entries"] = [e for e in job["entries"] if e["messageId"] != entry["messageId"]]
+    await context.state.set(BATCH_JOBS_GROUP, job["id"], job)
+
+
+async def classify_sync(context, entry):
+    """Classifies a queued entry with a regular completion call; re-queues it if that fails too"""
+    try:
+        classification_json = await stream_classification(entry["fullText"])
+        await emit_classification(context, entry["input"], classification_json, entry.get("cacheKey"), entry.get("useFusedExtraction", True))
+    except Exception as e:
+        context.logger.error(f"❌ Sync classification failed for {entry['messageId']}, re-queuing: {str(e)}")
+        await context.state.set(BATCH_PENDING_GROUP, entry["messageId"], entry)
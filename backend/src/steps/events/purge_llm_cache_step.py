@@ -0,0 +1,22 @@
+from _llm_cache import CACHE_GROUP, is_expired
+
+config = {
+    "type": "cron",
+    "name": "PurgeLLMCache",
+    "description": "Deletes expired classification/extraction responses from the LLM cache",
+    "cron": "0 3 * * *",
+    "emits": [],
+    "flows": ["inquiry-processing"]
+}
+
+
+async def handler(context):
+    """Expired entries are also dropped on read; this catches the ones that are never read again"""
+    entries = await context.state.get_group(CACHE_GROUP) or []
+    purged = 0
+    for entry in entries:
+        if entry.get("key") and is_expired(entry):
+            await context.state.delete(CACHE_GROUP, entry["key"])
+            purged += 1
+
+    context.logger.info(f"🧹 Purged {purged}/{len(entries)} expired LLM cache entries")
@@ -21,7 +21,8 @@ export const config = {
             confidence: { type: 'number' },
             reasoning: { type: 'string' },
             keywords: { type: 'array' },
-            classifiedAt: { type: 'string' }
+            classifiedAt: { type: 'string' },
+            preExtracted: { type: 'object' }
         },
         required: ['messageId', 'source', 'body', 'isBrandInquiry']
     }
@@ -42,7 +43,8 @@ export const handler = async (input, ctx) => {
         classifiedAt,
         inReplyTo,
         references,
-        emailHeaders
+        emailHeaders,
+        preExtracted
     } = input
 
     ctx.logger.info('='.repeat(80))
@@ -138,7 +140,9 @@ export const handler = async (input, ctx) => {
                 body: cleanBody, // Pass clean text, not HTML
                 senderId: senderId,
                 sender: sender, // Pass it down
-                threadKey
+                threadKey,
+                // Lets ExtractInquiry skip its AI call when classification already extracted the details
+                ...(preExtracted && { preExtracted })
             }
         })
 